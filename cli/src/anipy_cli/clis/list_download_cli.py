@@ -1,10 +1,16 @@
+import functools
 import json
+import os
+import re
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Type
 
 from anipy_api.anime import Anime
 from anipy_api.download import Downloader
-from anipy_api.provider import LanguageTypeEnum, list_providers
+from anipy_api.provider import BaseProvider, LanguageTypeEnum, list_providers
 
 from anipy_cli.clis.base_cli import CliBase
 from anipy_cli.colors import colors, cprint
@@ -17,11 +23,118 @@ from anipy_cli.prompts import (
 )
 from anipy_cli.util import error
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 if TYPE_CHECKING:
     from anipy_api.provider import Episode
 
     from anipy_cli.arg_parser import CliArgs
 
+# State files smaller than this are parsed in one go, ijson's per-call
+# overhead only pays off for bigger queues.
+_STREAM_THRESHOLD = 64 * 1024
+
+# Numbers in a filename, candidates for the episode number
+_EP_RE = re.compile(r"\d+")
+
+# Seconds a folder mtime has to lie in the past before a negative disk
+# check is cached for it. Filesystems like FAT/exFAT only store mtimes
+# with a 2 second resolution, some network mounts are even coarser, so
+# this can't rule out every missed change.
+_MTIME_SLACK = 5.0
+
+# Version of the state file layout. Version 1 files have no "version"
+# key and store the anime of each entry row-wise in "anime", version 2
+# stores them column-wise in "cols" so the keys are not repeated for
+# every anime.
+_STATE_VERSION = 2
+
+_STATE_ERRORS: Tuple[type, ...] = (json.JSONDecodeError, KeyError)
+if ijson is not None:
+    _STATE_ERRORS += (ijson.JSONError,)
+
+
+def _entry_row(cols: Dict[str, List[Any]], i: int) -> Dict[str, Any]:
+    # Rows without a key are stored as null in its column, leave it out
+    # again so rows round-trip unchanged
+    return {key: col[i] for key, col in cols.items() if col[i] is not None}
+
+
+def _pack_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    packed = {key: val for key, val in entry.items() if key != "anime"}
+    # Union of the keys of all rows, in the order they first appear
+    keys = dict.fromkeys(key for a in entry["anime"] for key in a)
+    packed["cols"] = {key: [a.get(key) for a in entry["anime"]] for key in keys}
+    return packed
+
+
+def _unpack_entry(packed: Dict[str, Any]) -> Dict[str, Any]:
+    if "cols" not in packed:
+        # Legacy layout, anime are already stored row-wise
+        return packed
+
+    cols = packed.pop("cols")
+    count = len(next(iter(cols.values()), []))
+    for key, col in cols.items():
+        if len(col) != count:
+            raise KeyError(key)
+
+    packed["anime"] = [_entry_row(cols, i) for i in range(count)]
+    return packed
+
+
+def _peek_state_version(f: BinaryIO) -> int:
+    # "version" is always written as the first key, so only the start of
+    # the file has to be parsed. Legacy files start with "entries".
+    events = ijson.parse(f)
+    for _, event, value in events:
+        if event == "map_key":
+            if value != "version":
+                return 1
+            return next(events)[2]
+    return 1
+
+
+def _dump_state(state: Dict[str, Any]) -> bytes:
+    state = {
+        "version": _STATE_VERSION,
+        **state,
+        "entries": [_pack_entry(e) for e in state["entries"]],
+    }
+    if orjson is not None:
+        return orjson.dumps(state, option=orjson.OPT_INDENT_2)
+    return json.dumps(state, indent=2).encode("utf-8")
+
+
+def _norm_ep(e: "Episode") -> "Episode":
+    # Whole episode numbers become ints, everything else stays a float
+    f = float(e)
+    i = int(f)
+    return i if i == f else f
+
+
+@functools.lru_cache(maxsize=1024)
+def _valid_pathname(name: str) -> str:
+    return Downloader._get_valid_pathname(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _lang(value: str) -> LanguageTypeEnum:
+    return LanguageTypeEnum[value.upper()]
+
+
+@functools.lru_cache(maxsize=1)
+def _provider_map() -> Dict[str, Type[BaseProvider]]:
+    return {p.NAME: p for p in list_providers()}
+
 
 class ListDownloadCli(CliBase):
     def __init__(self, options: "CliArgs"):
@@ -36,6 +149,13 @@ class ListDownloadCli(CliBase):
         self.anime_names: List[str] = []
         self.state: Dict[str, Any] = {"entries": []}
         self.picked: List[Tuple[Anime, LanguageTypeEnum, List["Episode"]]] = []
+        # State records of each picked anime and their entries, parallel to
+        # `self.picked`
+        self._picked_data: List[Dict[str, Any]] = []
+        self._picked_entry: List[Dict[str, Any]] = []
+
+        self._entry_by_query: Dict[str, Dict[str, Any]] = {}
+        self._state_dirty = False
 
     def print_header(self):
         cprint(colors.GREEN, "***List Download Mode***")
@@ -43,32 +163,39 @@ class ListDownloadCli(CliBase):
         if not self.list_file.is_file():
             error(f"file not found: {self.list_file}", fatal=True)
 
-        self.anime_names = [
-            line.strip()
-            for line in self.list_file.read_text().splitlines()
-            if line.strip()
-        ]
+        with self.list_file.open("r", encoding="utf-8") as f:
+            self.anime_names = [
+                line for line in (raw.strip() for raw in f) if line
+            ]
 
         if not self.anime_names:
             error("the list file is empty", fatal=True)
 
         if self.state_file.is_file():
+            entries: List[Dict[str, Any]] = []
+            completed = 0
             try:
-                self.state = json.loads(self.state_file.read_text())
-                completed = sum(
-                    1
-                    for e in self.state["entries"]
-                    if e["status"] == "completed"
-                )
-                total = len(self.state["entries"])
+                for packed in self._iter_state_entries():
+                    if "cols" not in packed:
+                        # Rewrite legacy state in the new layout on next save
+                        self._state_dirty = True
+                    entry = _unpack_entry(packed)
+                    entries.append(entry)
+                    if entry["status"] == "completed":
+                        completed += 1
+            except _STATE_ERRORS:
+                entries = []
+            else:
                 cprint(
                     colors.GREEN,
                     "Resuming from: ",
                     colors.END,
-                    f"{self.state_file.name} ({completed}/{total} completed)",
+                    f"{self.state_file.name} ({completed}/{len(entries)} completed)",
                 )
-            except (json.JSONDecodeError, KeyError):
-                self.state = {"entries": []}
+            self.state = {"entries": entries}
+
+        for entry in self.state["entries"]:
+            self._index_entry(entry)
 
         cprint(
             colors.GREEN,
@@ -83,41 +210,107 @@ class ListDownloadCli(CliBase):
             str(self.dl_path),
         )
 
-    def _find_state_entry(self, query: str) -> Optional[Dict[str, Any]]:
-        for entry in self.state["entries"]:
-            if entry["query"] == query:
-                return entry
-        return None
+    def _iter_state_entries(self) -> Iterator[Dict[str, Any]]:
+        if ijson is None or self.state_file.stat().st_size < _STREAM_THRESHOLD:
+            state = json.loads(self.state_file.read_bytes())
+            self._check_state_version(state.get("version", 1))
+            yield from state["entries"]
+            return
+
+        with self.state_file.open("rb") as f:
+            self._check_state_version(_peek_state_version(f))
+            f.seek(0)
+            yield from ijson.items(f, "entries.item", use_float=True)
+
+    def _check_state_version(self, version: int):
+        if version > _STATE_VERSION:
+            error(
+                f"{self.state_file} was written by a newer version of anipy-cli, "
+                "please update",
+                fatal=True,
+            )
 
-    def _save_state(self):
-        self.state_file.write_text(json.dumps(self.state, indent=2))
+    def _index_entry(self, entry: Dict[str, Any]):
+        self._entry_by_query.setdefault(entry["query"], entry)
 
-    def _check_already_on_disk(self, anime_data: Dict[str, Any]) -> bool:
-        anime_name = Downloader._get_valid_pathname(anime_data["name"])
-        anime_folder = self.dl_path / anime_name
-        if not anime_folder.is_dir():
+    def _find_state_entry(self, query: str) -> Optional[Dict[str, Any]]:
+        return self._entry_by_query.get(query)
+
+    def _save_state(self) -> bool:
+        if not self._state_dirty:
             return False
 
-        existing_files = {p.stem for p in anime_folder.iterdir() if p.is_file()}
-        for ep in anime_data["episodes"]:
-            ep_str = str(ep).zfill(2)
-            if not any(ep_str in f for f in existing_files):
-                return False
+        # Write to a temporary file first, so a crash mid-write can't
+        # leave a truncated state file behind
+        tmp_file = self.state_file.with_suffix(".json.tmp")
+        tmp_file.write_bytes(_dump_state(self.state))
+        os.replace(tmp_file, self.state_file)
+        self._state_dirty = False
         return True
 
+    def _check_already_on_disk(
+        self, anime_data: Dict[str, Any]
+    ) -> Tuple[bool, Optional[float]]:
+        """Check if all episodes of an anime are already downloaded.
+
+        This runs in worker threads, so it must not modify any state.
+
+        Returns:
+            Whether all episodes were found and, if they were not, the
+            mtime of the scanned folder to remember for the next run
+        """
+        anime_name = _valid_pathname(anime_data["name"])
+        anime_folder = self.dl_path / anime_name
+        try:
+            folder_stat = anime_folder.stat()
+        except OSError:
+            return False, None
+        if not stat.S_ISDIR(folder_stat.st_mode):
+            return False, None
+
+        # The folder did not change since the last scan came up short,
+        # so the result would be the same. This relies on the mtime
+        # changing whenever a file is added, see `_MTIME_SLACK`.
+        if anime_data.get("disk_checked_mtime") == folder_stat.st_mtime:
+            return False, None
+
+        with os.scandir(anime_folder) as it:
+            existing_files = {
+                os.path.splitext(e.name)[0]
+                for e in it
+                if e.is_file()
+            }
+        # Drop the show name first, digits in the title are no episodes
+        existing_eps = {
+            n
+            for f in existing_files
+            for n in _EP_RE.findall(f.replace(anime_name, "", 1))
+        }
+        for ep in anime_data["episodes"]:
+            # Same episode token `get_download_path` puts into the filename
+            ep_str = _valid_pathname(str(ep).zfill(2))
+            if ep_str not in existing_eps:
+                # Files added in the same mtime tick as the scan would go
+                # unnoticed, so only remember mtimes that are old enough
+                if time.time() - folder_stat.st_mtime < _MTIME_SLACK:
+                    return False, None
+                return False, folder_stat.st_mtime
+        return True, None
+
     def _resolve_anime(self, provider_name: str, identifier: str, name: str, languages: List[str]) -> Anime:
-        for p_cls in list_providers():
-            if p_cls.NAME == provider_name:
-                config = Config()
-                url_override = config.provider_urls.get(p_cls.NAME, None)
-                provider = p_cls(url_override)
-                return Anime(
-                    provider=provider,
-                    name=name,
-                    identifier=identifier,
-                    languages={LanguageTypeEnum[l.upper()] for l in languages},
-                )
-        error(f"provider '{provider_name}' not found", fatal=True)
+        p_cls = _provider_map().get(provider_name)
+        if p_cls is None:
+            error(f"provider '{provider_name}' not found", fatal=True)
+
+        config = Config()
+        url_override = config.provider_urls.get(p_cls.NAME, None)
+        provider = p_cls(url_override)
+        return Anime(
+            provider=provider,
+            name=name,
+            identifier=identifier,
+            languages={_lang(l) for l in languages},
+        )
 
     def take_input(self):
         total = len(self.anime_names)
@@ -188,37 +381,65 @@ class ListDownloadCli(CliBase):
                         "name": anime.name,
                         "languages": [l.value for l in anime.languages],
                         "lang": lang.value,
-                        "episodes": [
-                            int(e) if isinstance(e, int) or (isinstance(e, float) and e.is_integer()) else float(e)
-                            for e in episodes
-                        ],
+                        "episodes": [_norm_ep(e) for e in episodes],
                         "downloaded": False,
                     }
                 )
 
             if entry["anime"]:
                 self.state["entries"].append(entry)
+                self._state_dirty = True
+                self._index_entry(entry)
 
         # Save state after all interactive input
-        self._save_state()
-        cprint(
-            colors.GREEN,
-            "\nSaved selections to: ",
-            colors.END,
-            str(self.state_file),
-        )
+        if self._save_state():
+            cprint(
+                colors.GREEN,
+                "\nSaved selections to: ",
+                colors.END,
+                str(self.state_file),
+            )
 
-        # Build the picked list, skipping already-downloaded anime
-        for entry in self.state["entries"]:
-            if entry["status"] == "completed":
-                continue
+        pending_entries = [
+            e for e in self.state["entries"] if e["status"] != "completed"
+        ]
+        pending = [
+            a
+            for e in pending_entries
+            for a in e["anime"]
+            if not a.get("downloaded", False)
+        ]
+
+        # Folder scans are I/O bound, run them concurrently and apply the
+        # results below. Nothing can be on disk if the download folder
+        # does not exist (yet), so skip the scans entirely then.
+        disk_checks: Dict[int, Tuple[bool, Optional[float]]] = {}
+        if pending and self.dl_path.is_dir():
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                disk_checks = dict(
+                    zip(
+                        map(id, pending),
+                        pool.map(self._check_already_on_disk, pending),
+                    )
+                )
 
+        # Build the picked list, skipping already-downloaded anime and
+        # updating entry statuses along the way
+        for entry in pending_entries:
             for anime_data in entry["anime"]:
                 if anime_data.get("downloaded", False):
                     continue
 
-                if self._check_already_on_disk(anime_data):
+                on_disk, folder_mtime = disk_checks.get(
+                    id(anime_data), (False, None)
+                )
+                if folder_mtime is not None:
+                    anime_data["disk_checked_mtime"] = folder_mtime
+                    self._state_dirty = True
+
+                if on_disk:
                     anime_data["downloaded"] = True
+                    self._state_dirty = True
                     cprint(
                         colors.GREEN,
                         f"  {anime_data['name']} — already on disk, skipping",
@@ -231,62 +452,65 @@ class ListDownloadCli(CliBase):
                     anime_data["name"],
                     anime_data["languages"],
                 )
-                lang = LanguageTypeEnum[anime_data["lang"].upper()]
-                episodes = [
-                    int(e) if isinstance(e, (int, float)) and float(e).is_integer() else float(e)
-                    for e in anime_data["episodes"]
-                ]
+                lang = _lang(anime_data["lang"])
+                episodes = [_norm_ep(e) for e in anime_data["episodes"]]
                 self.picked.append((anime, lang, episodes))
+                self._picked_data.append(anime_data)
+                self._picked_entry.append(entry)
 
-        # Update entry statuses and save after disk checks
-        for entry in self.state["entries"]:
             self._check_entry_completed(entry)
+
+        # Only writes if disk checks changed anything
         self._save_state()
 
         if not self.picked:
             cprint(colors.GREEN, "\nAll anime already downloaded!")
             return False
 
-    def _find_anime_data(self, anime_name: str, provider: str) -> Optional[Dict[str, Any]]:
-        for entry in self.state["entries"]:
-            for anime_data in entry["anime"]:
-                if anime_data["name"] == anime_name and anime_data["provider"] == provider:
-                    return anime_data
-        return None
-
     def _check_entry_completed(self, entry: Dict[str, Any]):
+        if entry["status"] == "completed":
+            return
+
         if all(a.get("downloaded", False) for a in entry["anime"]):
             entry["status"] = "completed"
+            self._state_dirty = True
 
     def process(self):
         if not self.picked:
             return
 
-        all_errors: List[Tuple[Anime, "Episode"]] = []
-
-        for anime, lang, episodes in self.picked:
+        pick_index: Dict[int, int] = {
+            id(anime): i for i, (anime, _, _) in enumerate(self.picked)
+        }
+        remaining_eps = [len(episodes) for _, _, episodes in self.picked]
+
+        def on_successful_download(
+            anime: Anime, ep: "Episode", lang: LanguageTypeEnum
+        ):
+            i = pick_index[id(anime)]
+            remaining_eps[i] -= 1
+            if remaining_eps[i] > 0:
+                return
+
+            self._picked_data[i]["downloaded"] = True
+            self._state_dirty = True
+            # Check if the whole entry is now complete
+            self._check_entry_completed(self._picked_entry[i])
+            self._save_state()
+
+        try:
             errors = DownloadComponent(
                 self.options, self.dl_path, "download"
             ).download_anime(
-                [(anime, lang, episodes)],
+                self.picked,
+                on_successful_download,
                 only_skip_ep_on_err=True,
                 sub_only=self.options.subtitles,
             )
+        finally:
+            self._save_state()
 
-            if not errors:
-                anime_data = self._find_anime_data(anime.name, anime.provider.NAME)
-                if anime_data:
-                    anime_data["downloaded"] = True
-                    # Check if the whole entry is now complete
-                    for entry in self.state["entries"]:
-                        if any(a is anime_data for a in entry["anime"]):
-                            self._check_entry_completed(entry)
-                            break
-                self._save_state()
-            else:
-                all_errors.extend(errors)
-
-        DownloadComponent.serve_download_errors(all_errors, only_skip_ep_on_err=True)
+        DownloadComponent.serve_download_errors(errors, only_skip_ep_on_err=True)
 
     def show(self):
         pass
@@ -68,7 +68,7 @@ class DownloadComponent:
             failed: List[Tuple[Anime, Episode]] = []
 
             for anime, lang, eps in picked:
-                failed = self.download_episodes(
+                failed += self.download_episodes(
                     s,
                     downloader,
                     anime,